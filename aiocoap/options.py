@@ -134,12 +134,15 @@ class Options(object):
     def decode(self, rawdata):
         """Passed a CoAP message body after the token as rawdata, fill self
         with the options starting at the beginning of rawdata, an return the
-        rest of the message (the body)."""
+        rest of the message (the body).
+
+        rawdata may also be a memoryview, in which case only the option values
+        and the body are copied out of it."""
         option_number = OptionNumber(0)
 
         while rawdata:
             if rawdata[0] == 0xFF:
-                return rawdata[1:]
+                return bytes(rawdata[1:])
             dllen = rawdata[0]
             delta = (dllen & 0xF0) >> 4
             length = (dllen & 0x0F)
@@ -149,7 +152,7 @@ class Options(object):
             option_number += delta
             if len(rawdata) < length:
                 raise UnparsableMessage("Option announced but absent")
-            option = option_number.create_option(decode=rawdata[:length])
+            option = option_number.create_option(decode=bytes(rawdata[:length]))
             self.add_option(option)
             rawdata = rawdata[length:]
         return b''
@@ -186,6 +189,13 @@ class Options(object):
         """Get option with specified number."""
         return self._options.get(number, ())
 
+    def option_numbers(self):
+        """Numbers of the options present, in no particular order.
+
+        This is cheaper than looking at the numbers through option_list when
+        the option values are not needed."""
+        return self._options.keys()
+
     def option_list(self):
         return chain.from_iterable(sorted(self._options.values(), key=lambda x: x[0].number))
 
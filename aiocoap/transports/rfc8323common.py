@@ -14,6 +14,12 @@ from aiocoap import optiontypes, util
 from aiocoap.numbers.codes import CSM, PING, PONG, RELEASE, ABORT
 from aiocoap import error
 
+def _first_critical_option(options):
+    """Return the lowest critical option number present in options, or None
+    if there is none"""
+    critical = [n for n in options.option_numbers() if n & 1]
+    return min(critical) if critical else None
+
 class CloseConnection(Exception):
     """Raised in RFC8323 common processing to trigger a connection shutdown on
     the TCP / WebSocket side.
@@ -108,7 +114,8 @@ class RFC8323Remote:
 
     # Utility methods for implementing an RFC8323 transport
 
-    def _send_initial_csm(self):
+    def _build_initial_csm(self):
+        """Create the CSM message that is sent at the start of a connection"""
         my_csm = Message(code=CSM)
         # this is a tad awkward in construction because the options objects
         # were designed under the assumption that the option space is constant
@@ -117,35 +124,42 @@ class RFC8323Remote:
         my_csm.opt.add_option(block_length)
         supports_block = optiontypes.UintOption(4, 0)
         my_csm.opt.add_option(supports_block)
-        self._send_message(my_csm)
+        return my_csm
+
+    def _send_initial_csm(self):
+        self._send_message(self._build_initial_csm())
+
+    def _send_pong(self, token):
+        """Send a Pong message in response to a Ping with the given token.
+
+        Transports can override this with a shortcut that does not need to
+        go through the full message serialization."""
+        pong = Message(code=PONG, token=token)
+        self._send_message(pong)
 
     def _process_signaling(self, msg):
         if msg.code == CSM:
             if self._remote_settings is None:
                 self._remote_settings = {}
-            for opt in msg.opt.option_list():
-                # FIXME: this relies on the relevant option numbers to be
-                # opaque; message parsing should already use the appropriate
-                # option types, or re-think the way options are parsed
-                if opt.number == 2:
-                    self._remote_settings['max-message-size'] = int.from_bytes(opt.value, 'big')
-                elif opt.number == 4:
-                    self._remote_settings['block-wise-transfer'] = True
-                elif opt.number.is_critical():
-                    self.abort("Option not supported", bad_csm_option=opt.number)
-                else:
-                    pass # ignoring elective CSM options
+            # FIXME: this relies on the relevant option numbers to be
+            # opaque; message parsing should already use the appropriate
+            # option types, or re-think the way options are parsed
+            max_message_size = msg.opt.get_option(2)
+            if max_message_size:
+                self._remote_settings['max-message-size'] = int.from_bytes(max_message_size[-1].value, 'big')
+            if msg.opt.get_option(4):
+                self._remote_settings['block-wise-transfer'] = True
+            # ignoring elective CSM options (the known ones are elective too)
+            unsupported = _first_critical_option(msg.opt)
+            if unsupported is not None:
+                self.abort("Option not supported", bad_csm_option=unsupported)
         elif msg.code in (PING, PONG, RELEASE, ABORT):
             # not expecting data in any of them as long as Custody is not implemented
-            for opt in msg.opt.option_list():
-                if opt.number.is_critical():
-                    self.abort("Unknown critical option")
-                else:
-                    pass
+            if _first_critical_option(msg.opt) is not None:
+                self.abort("Unknown critical option")
 
             if msg.code == PING:
-                pong = Message(code=PONG, token=msg.token)
-                self._send_message(pong)
+                self._send_pong(msg.token)
             elif msg.code == PONG:
                 pass
             elif msg.code == RELEASE:
@@ -4,51 +4,98 @@
 
 import asyncio
 import socket
+import struct
+import weakref
 
 from aiocoap.transports import rfc8323common
 from aiocoap import interfaces, error, util
 from aiocoap import COAP_PORT, Message
 from aiocoap import defaults
+from aiocoap.numbers.codes import PONG
 from ..util.asyncio import py38args
+from ..util import socknumbers
 
-def _extract_message_size(data: bytes):
-    """Read out the full length of a CoAP messsage represented by data.
+# Free space below which get_buffer compacts or grows the receive buffer
+# rather than handing out the remaining tail. The buffer starts out empty, is
+# grown on demand (eg. for large messages), and returned to this size when
+# idle.
+_SPOOL_MIN_FREE = 4096
+
+# Size of a serialized message from which on the socket is corked (see
+# TcpConnection._cork) while it is written
+_CORK_THRESHOLD = 16384
+_TCP_CORK = getattr(socknumbers, 'TCP_CORK', None) or getattr(socknumbers, 'TCP_NOPUSH', None)
+
+# Amount of data queued while the transport has paused writing, above which
+# the peer is considered stalled and the connection is aborted
+_WRITE_QUEUE_LIMIT = 4 * 1024 * 1024
+
+# Network byte order encodings of the extended length field
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+
+def _extract_message_size(data: bytes, offset: int = 0, max_len=None):
+    """Read out the full length of a CoAP messsage represented by data
+    (starting at the given offset, so that a spool buffer does not need to be
+    resliced to look into it).
 
     Returns None if data is too short to read the (full) length.
 
+    If max_len is given and the first byte alone shows that the message will
+    be longer than that, the message's minimal length is returned without
+    waiting for the extended length; callers rejecting messages larger than
+    max_len can thus do so early.
+
     The number returned is the number of bytes that has to be read into data to
     start reading the next message; it consists of a constant term, the token
     length and the extended length of options-plus-payload."""
 
-    if not data:
+    if len(data) <= offset:
         return None
 
-    l = data[0] >> 4
-    tokenoffset = 2
-    tkl = data[0] & 0x0f
-
-    if l >= 13:
-        if l == 13:
-            extlen = 1
-            offset = 13
-        elif l == 14:
-            extlen = 2
-            offset = 269
-        else:
-            extlen = 4
-            offset = 65805
-        if len(data) < extlen + 1:
-            return None
-        tokenoffset = 2 + extlen
-        l = int.from_bytes(data[1:1 + extlen], "big") + offset
-    return tokenoffset, tkl, l
-
-def _decode_message(data: bytes) -> Message:
-    tokenoffset, tkl, _ = _extract_message_size(data)
+    first = data[offset]
+    l = first >> 4
+    tkl = first & 0x0f
+
+    if l < 13:
+        return 2 + tkl + l
+
+    if l == 13:
+        extlen, lenoffset, unpacker = 1, 13, _U8
+    elif l == 14:
+        extlen, lenoffset, unpacker = 2, 269, _U16
+    else:
+        extlen, lenoffset, unpacker = 4, 65805, _U32
+    if max_len is not None and 2 + extlen + tkl + lenoffset > max_len:
+        return 2 + extlen + tkl + lenoffset
+    if len(data) < offset + extlen + 1:
+        return None
+    l = unpacker.unpack_from(data, offset + 1)[0] + lenoffset
+    return 2 + extlen + tkl + l
+
+def _extract_header(data: bytes):
+    """Read out the token offset and the token length of a CoAP message that
+    is known to be present in data completely."""
+
+    first = data[0]
+    l = first >> 4
+    if l < 13:
+        tokenoffset = 2
+    else:
+        tokenoffset = (3, 4, 6)[l - 13]
+    return tokenoffset, first & 0x0f
+
+def _decode_message(data) -> Message:
+    """Decode a complete message from data.
+
+    data can be bytes or a memoryview into a receive buffer; in the latter
+    case, only the token, the option values and the payload are copied out."""
+    tokenoffset, tkl = _extract_header(data)
     if tkl > 8:
         raise error.UnparsableMessage("Overly long token")
     code = data[tokenoffset - 1]
-    token = data[tokenoffset:tokenoffset + tkl]
+    token = bytes(data[tokenoffset:tokenoffset + tkl])
 
     msg = Message(code=code, token=token)
 
@@ -60,32 +107,45 @@ def _encode_length(l: int):
     if l < 13:
         return (l, b"")
     elif l < 269:
-        return (13, (l - 13).to_bytes(1, 'big'))
+        return (13, _U8.pack(l - 13))
     elif l < 65805:
-        return (14, (l - 269).to_bytes(2, 'big'))
+        return (14, _U16.pack(l - 269))
     else:
-        return (15, (l - 65805).to_bytes(4, 'big'))
+        return (15, _U32.pack(l - 65805))
 
 def _serialize(msg: Message) -> bytes:
-    data = [msg.opt.encode()]
-    if msg.payload:
-        data += [b'\xff', msg.payload]
-    data = b"".join(data)
-    l, extlen = _encode_length(len(data))
+    opt_encoded = msg.opt.encode()
+    payload = msg.payload
+    if payload:
+        l, extlen = _encode_length(len(opt_encoded) + 1 + len(payload))
+    else:
+        l, extlen = _encode_length(len(opt_encoded))
 
     tkl = len(msg.token)
     if tkl > 8:
         raise ValueError("Overly long token")
 
-    return b"".join((
-            bytes(((l << 4) | tkl,)),
-            extlen,
-            bytes((msg.code,)),
-            msg.token,
-            data
-            ))
-
-class TcpConnection(asyncio.Protocol, rfc8323common.RFC8323Remote, interfaces.EndpointAddress):
+    # Built in one buffer, so that it can go out in a single write
+    out = bytearray()
+    out.append((l << 4) | tkl)
+    out += extlen
+    out.append(msg.code)
+    out += msg.token
+    out += opt_encoded
+    if payload:
+        out.append(0xff)
+        out += payload
+    return bytes(out)
+
+# Serialized Pong messages without options or payload, indexed by token length
+# (the token is all that needs to be appended)
+_PONG_HEADER_BY_TKL = [bytes((tkl, PONG)) for tkl in range(9)]
+
+# Serialized initial CSMs, indexed by the local maximum message size they
+# announce
+_INITIAL_CSM_CACHE = {}
+
+class TcpConnection(asyncio.BufferedProtocol, rfc8323common.RFC8323Remote, interfaces.EndpointAddress):
     # currently, both the protocol and the EndpointAddress are the same object.
     # if, at a later point in time, the keepaliving of TCP connections should
     # depend on whether the library user still keeps a usable address around,
@@ -97,12 +157,30 @@ class TcpConnection(asyncio.Protocol, rfc8323common.RFC8323Remote, interfaces.En
         self.log = log
         self.loop = loop
 
-        self._spool = b""
+        # Receive buffer handed out to the transport through get_buffer. Data
+        # up to _read_pos has been processed, data up to _write_pos has been
+        # received.
+        self._spool = bytearray()
+        self._read_pos = 0
+        self._write_pos = 0
 
         self._remote_settings = None
 
         self._transport = None
+        # Underlying TCP socket, if available for setting options on
+        self._sock = None
+        self._corked = False
+
+        # Serialized data held back while the transport has paused writing
+        self._writing_paused = False
+        self._write_queue = []
+        self._write_queue_size = 0
+        # Set once the connection is aborted or lost; nothing is written any
+        # more from then on
+        self._closed = False
         self._local_is_server = is_server
+        # Key under which a TCPClient filed this connection, if any
+        self._pool_key = None
 
     @property
     def scheme(self):
@@ -110,11 +188,72 @@ class TcpConnection(asyncio.Protocol, rfc8323common.RFC8323Remote, interfaces.En
 
     def _send_message(self, msg: Message):
         self.log.debug("Sending message: %r", msg)
-        self._transport.write(_serialize(msg))
+        self._write(_serialize(msg))
+
+    def _write(self, data):
+        """Write serialized messages to the transport, or queue them while
+        the transport has paused writing."""
+        if self._closed:
+            return
+        if not self._writing_paused:
+            if len(data) >= _CORK_THRESHOLD:
+                self._cork()
+            self._transport.write(data)
+            return
+
+        self._write_queue.append(data)
+        self._write_queue_size += len(data)
+        if self._write_queue_size > _WRITE_QUEUE_LIMIT:
+            self.abort("Peer is not reading")
+
+    def _drop_write_queue(self):
+        self._write_queue = []
+        self._write_queue_size = 0
+
+    def _cork(self):
+        """Hold back partial segments on the socket until the next loop
+        iteration.
+
+        With Nagle's algorithm disabled, this allows large messages to go out
+        in full segments without delaying small ones. Nothing happens if the
+        platform does not provide the socket option."""
+        if self._corked or self._sock is None or _TCP_CORK is None:
+            return
+        try:
+            self._sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 1)
+        except OSError:
+            return
+        self._corked = True
+        self.loop.call_soon(self._uncork)
+
+    def _uncork(self):
+        self._corked = False
+        try:
+            self._sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 0)
+        except OSError:
+            # Socket was closed in the meantime
+            pass
+
+    def _send_initial_csm(self):
+        serialized = _INITIAL_CSM_CACHE.get(self._my_max_message_size)
+        if serialized is None:
+            serialized = _serialize(self._build_initial_csm())
+            _INITIAL_CSM_CACHE[self._my_max_message_size] = serialized
+        self.log.debug("Sending initial CSM")
+        self._write(serialized)
+
+    def _send_pong(self, token):
+        self.log.debug("Sending Pong with token %r", token)
+        self._write(_PONG_HEADER_BY_TKL[len(token)] + token)
 
     def _abort_with(self, abort_msg):
+        self._closed = True
         if self._transport is not None:
-            self._send_message(abort_msg)
+            # Written past any queued data: that will not be sent any more
+            # anyway, and the transport takes care of flushing before closing
+            self.log.debug("Sending message: %r", abort_msg)
+            self._drop_write_queue()
+            self._transport.write(_serialize(abort_msg))
             self._transport.close()
         else:
             # FIXME: find out how this happens; i've only seen it after nmap
@@ -123,11 +262,19 @@ class TcpConnection(asyncio.Protocol, rfc8323common.RFC8323Remote, interfaces.En
             # bypass the server shutdown.
             self._ctx = None
 
-    # implementing asyncio.Protocol
+    # implementing asyncio.BufferedProtocol
 
     def connection_made(self, transport):
         self._transport = transport
 
+        # Most messages are small and answered quickly, so Nagle's algorithm
+        # would only introduce delays (asyncio's own transports set this by
+        # default already, but other event loops need not)
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+
         ssl_object = transport.get_extra_info('ssl_object')
         if ssl_object is not None:
             server_name = getattr(ssl_object, "indicated_server_name", None)
@@ -160,55 +307,120 @@ class TcpConnection(asyncio.Protocol, rfc8323common.RFC8323Remote, interfaces.En
         # * mark the address as erroneous so it won't be recognized by
         #   fill_or_recognize_remote
 
+        self._closed = True
+        self._drop_write_queue()
+
         self._ctx._dispatch_error(self, exc)
 
-    def data_received(self, data):
-        # A rope would be more efficient here, but the expected case is that
-        # _spool is b"" and spool gets emptied soon -- most messages will just
-        # fit in a single TCP package and not be nagled together.
-        #
-        # (If this does become a bottleneck, say self._spool = SomeRope(b"")
-        # and barely change anything else).
-
-        self._spool += data
-
-        while True:
-            msglen = _extract_message_size(self._spool)
-            if msglen is None:
-                break
-            msglen = sum(msglen)
-            if msglen > self._my_max_message_size:
-                self.abort("Overly large message announced")
-                return
+    def get_buffer(self, sizehint):
+        # The size hint is not followed: some transports (like asyncio's SSL
+        # one) ask for large buffers for every read, which would make every
+        # idle connection hold one.
+        return self._reserve(_SPOOL_MIN_FREE)
 
-            if msglen > len(self._spool):
-                break
+    def _reserve(self, needed):
+        """Return a view into the spool's free tail of at least the given
+        size.
 
-            msg = self._spool[:msglen]
-            try:
-                msg = _decode_message(msg)
-            except error.UnparsableMessage:
-                self.abort("Failed to parse message")
-                return
-            msg.remote = self
+        No views into the spool are held across calls (the transport's view
+        is released after buffer_updated returns), so this is the place where
+        the spool can be resized."""
 
-            self.log.debug("Received message: %r", msg)
+        if self._read_pos == self._write_pos:
+            self._read_pos = self._write_pos = 0
+            if len(self._spool) > _SPOOL_MIN_FREE:
+                self._spool = bytearray(_SPOOL_MIN_FREE)
 
-            self._spool = self._spool[msglen:]
+        if len(self._spool) - self._write_pos < needed:
+            pending = self._write_pos - self._read_pos
+            if self._read_pos:
+                self._spool[:pending] = self._spool[self._read_pos:self._write_pos]
+                self._read_pos = 0
+                self._write_pos = pending
+            if len(self._spool) - pending < max(needed, len(self._spool) // 2):
+                # Growing by at least the current size keeps the cost of
+                # compaction and growth amortized constant per received byte
+                self._spool.extend(bytes(max(needed, len(self._spool))))
 
-            if msg.code.is_signalling():
-                try:
-                    self._process_signaling(msg)
-                except rfc8323common.CloseConnection as e:
-                    self._ctx._dispatch_error(self, e.args[0])
-                    self._transport.close()
-                continue
-
-            if self._remote_settings is None:
-                self.abort("No CSM received")
-                return
+        return memoryview(self._spool)[self._write_pos:]
+
+    def buffer_updated(self, nbytes):
+        self._write_pos += nbytes
 
-            self._ctx._dispatch_incoming(self, msg)
+        with memoryview(self._spool)[:self._write_pos] as data:
+            self._process_spool(data)
+
+    def data_received(self, data):
+        # Only used by event loops that do not support BufferedProtocol
+        with self._reserve(len(data)) as buf:
+            buf[:len(data)] = data
+        self.buffer_updated(len(data))
+
+    def _process_spool(self, data):
+        """Process all complete messages in data (the received part of the
+        spool) starting at _read_pos, and advance _read_pos past them."""
+
+        # Regular messages are collected and dispatched together; signalling
+        # messages are processed in sequence, after everything before them has
+        # been dispatched.
+        pending = []
+        abort_reason = None
+
+        # Bound to locals as they are used for every message in the loop
+        extract = _extract_message_size
+        decode = _decode_message
+        maxsize = self._my_max_message_size
+        debug = self.log.debug
+        datalen = len(data)
+        pos = self._read_pos
+
+        try:
+            while True:
+                msglen = extract(data, pos, maxsize)
+                if msglen is None:
+                    break
+                if msglen > maxsize:
+                    abort_reason = "Overly large message announced"
+                    break
+
+                if pos + msglen > datalen:
+                    break
+
+                try:
+                    msg = decode(data[pos:pos + msglen])
+                except error.UnparsableMessage:
+                    abort_reason = "Failed to parse message"
+                    break
+                msg.remote = self
+
+                debug("Received message: %r", msg)
+
+                pos += msglen
+
+                # Inlined msg.code.is_signalling()
+                if msg.code >= 224:
+                    if pending:
+                        self._ctx._dispatch_incoming_batch(self, pending)
+                        pending = []
+                    try:
+                        self._process_signaling(msg)
+                    except rfc8323common.CloseConnection as e:
+                        self._ctx._dispatch_error(self, e.args[0])
+                        self._transport.close()
+                    continue
+
+                if self._remote_settings is None:
+                    abort_reason = "No CSM received"
+                    break
+
+                pending.append(msg)
+        finally:
+            self._read_pos = pos
+
+        if pending:
+            self._ctx._dispatch_incoming_batch(self, pending)
+        if abort_reason is not None:
+            self.abort(abort_reason)
 
     def eof_received(self):
         # FIXME: as with connection_lost, but less noisy if announced
@@ -216,12 +428,16 @@ class TcpConnection(asyncio.Protocol, rfc8323common.RFC8323Remote, interfaces.En
         pass
 
     def pause_writing(self):
-        # FIXME: do something ;-)
-        pass
+        self._writing_paused = True
 
     def resume_writing(self):
-        # FIXME: do something ;-)
-        pass
+        self._writing_paused = False
+        queue = self._write_queue
+        self._drop_write_queue()
+        # If writing gets paused again on the way, the rest is queued again;
+        # if the connection gets aborted, the rest is dropped by _write
+        for data in queue:
+            self._write(data)
 
     # RFC8323Remote.release recommends subclassing this, but there's no easy
     # awaitable here yet, and no important business to finish, timeout-wise.
@@ -245,16 +461,19 @@ class _TCPPooling:
 
     # used by the TcpConnection instances
 
-    def _dispatch_incoming(self, connection, msg):
-        if msg.code == 0:
-            pass
-
-        if msg.code.is_response():
-            self._tokenmanager.process_response(msg)
-            # ignoring the return value; unexpected responses can be the
-            # asynchronous result of cancelled observations
-        else:
-            self._tokenmanager.process_request(msg)
+    def _dispatch_incoming_batch(self, connection, msgs):
+        """Pass a list of messages that were received together on to the
+        token manager"""
+        process_request = self._tokenmanager.process_request
+        process_response = self._tokenmanager.process_response
+        for msg in msgs:
+            # Inlined msg.code.is_response()
+            if 64 <= msg.code < 192:
+                process_response(msg)
+                # ignoring the return value; unexpected responses can be the
+                # asynchronous result of cancelled observations
+            else:
+                process_request(msg)
 
     def _dispatch_error(self, connection, exc):
         self._evict_from_pool(connection)
@@ -275,7 +494,9 @@ class _TCPPooling:
 
 class TCPServer(_TCPPooling, interfaces.TokenInterface):
     def __init__(self):
-        self._pool = set()
+        # Connections are kept alive by their transports; closed ones drop out
+        # even if they were never evicted explicitly.
+        self._pool = weakref.WeakSet()
 
     @classmethod
     async def create_server(cls, bind, tman: interfaces.TokenManager, log, loop, *, _server_context=None):
@@ -304,8 +525,7 @@ class TCPServer(_TCPPooling, interfaces.TokenInterface):
     def _evict_from_pool(self, connection):
         # May easily happen twice, once when an error comes in and once when
         # the connection is (subsequently) closed.
-        if connection in self._pool:
-            self._pool.remove(connection)
+        self._pool.discard(connection)
 
     # implementing TokenInterface
 
@@ -328,7 +548,7 @@ class TCPServer(_TCPPooling, interfaces.TokenInterface):
                     c.release(),
                     **py38args(name="Close client %s" % c))
                 for c
-                in self._pool
+                in list(self._pool)
                 ]
         shutdowns.append(asyncio.create_task(
                 self.server.wait_closed(),
@@ -338,7 +558,7 @@ class TCPServer(_TCPPooling, interfaces.TokenInterface):
 
 class TCPClient(_TCPPooling, interfaces.TokenInterface):
     def __init__(self):
-        self._pool = {} # (host, port) -> connection
+        self._pool = {} # (host, port) -> task resulting in the connection
         # note that connections are filed by host name, so different names for
         # the same address might end up with different connections, which is
         # probably okay for TCP, and crucial for later work with TLS.
@@ -353,21 +573,38 @@ class TCPClient(_TCPPooling, interfaces.TokenInterface):
             host, port = util.hostportsplit(message.unresolved_remote)
             port = port or self._default_port
 
-        if (host, port) in self._pool:
-            return self._pool[(host, port)]
-
+        key = (host, port)
+        if key not in self._pool:
+            # Filed before the connection is made, so that concurrent requests
+            # to the same remote wait for this connection rather than starting
+            # their own
+            self._pool[key] = asyncio.create_task(
+                    self._connect(key, message.unresolved_remote),
+                    **py38args(name="Connect to %s:%s" % key))
+
+        # Shielded so that a cancelled request does not take down the
+        # connection attempt other requests might be waiting for
+        return await asyncio.shield(self._pool[key])
+
+    async def _connect(self, key, unresolved_remote):
+        host, port = key
         try:
-            _, protocol = await self.loop.create_connection(
-                    lambda: TcpConnection(self, self.log, self.loop,
-                        is_server=False),
-                    host, port,
-                    ssl=self._ssl_context_factory(message.unresolved_remote))
-        except socket.gaierror as e:
-            raise error.ResolutionError("No address information found for requests to %r" % host) from e
-        except OSError as e:
-            raise error.NetworkError("Connection failed to %r" % host) from e
-
-        self._pool[(host, port)] = protocol
+            try:
+                _, protocol = await self.loop.create_connection(
+                        lambda: TcpConnection(self, self.log, self.loop,
+                            is_server=False),
+                        host, port,
+                        ssl=self._ssl_context_factory(unresolved_remote))
+            except socket.gaierror as e:
+                raise error.ResolutionError("No address information found for requests to %r" % host) from e
+            except OSError as e:
+                raise error.NetworkError("Connection failed to %r" % host) from e
+        except BaseException:
+            # Later requests should try again
+            self._pool.pop(key)
+            raise
+
+        protocol._pool_key = key
 
         return protocol
 
@@ -376,13 +613,14 @@ class TCPClient(_TCPPooling, interfaces.TokenInterface):
         return None
 
     def _evict_from_pool(self, connection):
-        keys = []
-        for k, p in self._pool.items():
-            if p is connection:
-                keys.append(k)
-        # should really be zero or one
-        for k in keys:
-            self._pool.pop(k)
+        # May easily happen twice, once when an error comes in and once when
+        # the connection is (subsequently) closed.
+        key = connection._pool_key
+        connecting = self._pool.get(key)
+        # Failed connection attempts remove themselves from the pool, so any
+        # task that is done in there has a result
+        if connecting is not None and connecting.done() and connecting.result() is connection:
+            self._pool.pop(key)
 
     @classmethod
     async def create_client_transport(cls, tman: interfaces.TokenManager, log, loop, credentials=None):
@@ -422,9 +660,10 @@ class TCPClient(_TCPPooling, interfaces.TokenInterface):
         self._tokenmanager = None
 
         shutdowns = [asyncio.create_task(
-            c.release(),
-            **py38args(name="Close client %s" % c))
-            for c in self._pool.values()]
+            c.result().release(),
+            **py38args(name="Close client %s" % c.result()))
+            for c in list(self._pool.values())
+            if c.done()]
         if not shutdowns:
             # wait is documented to require a non-empty set
             return
@@ -52,6 +52,19 @@ except ImportError:
     if sys.platform == 'linux':
         MSG_ERRQUEUE = 8192
 
+# Holding back partial TCP segments is called TCP_CORK on Linux and
+# TCP_NOPUSH on the BSDs (including macOS)
+try:
+    from socket import TCP_CORK  # noqa: F401 (re-exported)
+except ImportError:
+    pass
+
+try:
+    from socket import TCP_NOPUSH  # noqa: F401 (re-exported)
+except ImportError:
+    if sys.platform == 'darwin' or 'bsd' in sys.platform:
+        TCP_NOPUSH = 4
+
 HAS_RECVERR = 'IP_RECVERR' in locals() and 'MSG_ERRQUEUE' in locals()
 """Indicates whether the discovered constants indicate that the Linux
 `setsockopt(IPV6, RECVERR)` / `recvmsg(..., MSG_ERRQUEUE)` mechanism is
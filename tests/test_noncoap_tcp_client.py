@@ -34,8 +34,6 @@ class TestNoncoapTCPClient(WithTestServer):
         messages = []
         while True:
             size = aiocoap.transports.tcp._extract_message_size(encoded)
-            if size is not None:
-                size = sum(size)
             if size is None or size > len(encoded):
                 return messages, encoded
 
@@ -165,3 +163,14 @@ class TestNoncoapTCPClient(WithTestServer):
     async def test_exotic_compulsory_csm_option_late(self):
         # send an empty CSM, and after that the one from compulsory_csm_option
         await self.should_abort_early(b'\0\xe1\x30\xe1\xe0\xf2\xf2')
+
+    # Signalling after the CSM
+
+    @no_warnings
+    @asynctest
+    async def test_ping(self):
+        # send an empty CSM, and a Ping with a 2 byte token
+        messages = await self.should_idle(b'\0\xe1\x02\xe2pi')
+        self.assertEqual(len(messages), 1, "Not exactly one (presumably pong) message received")
+        self.assertEqual(messages[0].code, aiocoap.PONG, "Received message is not a pong message")
+        self.assertEqual(messages[0].token, b'pi', "Pong does not carry the ping's token")
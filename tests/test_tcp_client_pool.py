@@ -0,0 +1,107 @@
+# SPDX-FileCopyrightText: Christian Amsüss and the aiocoap contributors
+#
+# SPDX-License-Identifier: MIT
+
+"""Exercise the connection pool of the CoAP over TCP client against a plain
+listener that merely counts incoming connections"""
+
+import asyncio
+import logging
+import socket
+import unittest
+
+import aiocoap
+from aiocoap import error
+from aiocoap.transports.tcp import TCPClient
+
+from .fixtures import WithAsyncLoop, asynctest
+from .common import tcp_disabled
+
+class _NullTokenManager:
+    def process_request(self, msg):
+        pass
+
+    def process_response(self, msg):
+        pass
+
+    def dispatch_error(self, exc, remote):
+        pass
+
+@unittest.skipIf(tcp_disabled, "TCP disabled in environment")
+class TestTCPClientPool(WithAsyncLoop):
+    def setUp(self):
+        super().setUp()
+
+        self.client = self.loop.run_until_complete(
+                TCPClient.create_client_transport(_NullTokenManager(),
+                    logging.getLogger("tcp-pool-test"), self.loop))
+        self.listener = None
+        self.accepted = 0
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.client.shutdown())
+        if self.listener is not None:
+            self.listener.close()
+            self.loop.run_until_complete(self.listener.wait_closed())
+
+        super().tearDown()
+
+    async def listen(self, port=0):
+        async def accept(reader, writer):
+            self.accepted += 1
+            await reader.read()
+            writer.close()
+        self.listener = await asyncio.start_server(accept, '127.0.0.1', port)
+        return self.listener.sockets[0].getsockname()[1]
+
+    def request_to(self, port):
+        message = aiocoap.Message(code=aiocoap.GET)
+        message.unresolved_remote = '127.0.0.1:%d' % port
+        return message
+
+    @asynctest
+    async def test_concurrent_requests_share_connection(self):
+        port = await self.listen()
+
+        first, second = await asyncio.gather(
+                self.client._spawn_protocol(self.request_to(port)),
+                self.client._spawn_protocol(self.request_to(port)),
+                )
+        await asyncio.sleep(0.05)
+
+        self.assertIs(first, second, "Concurrent requests got different connections")
+        self.assertEqual(self.accepted, 1, "More than one connection was established")
+
+    @asynctest
+    async def test_cancelled_request_leaves_connection_attempt(self):
+        port = await self.listen()
+
+        cancelled = asyncio.ensure_future(self.client._spawn_protocol(self.request_to(port)))
+        waiting = asyncio.ensure_future(self.client._spawn_protocol(self.request_to(port)))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+
+        protocol = await waiting
+        await asyncio.sleep(0.05)
+
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(self.accepted, 1, "Connection was not established exactly once")
+        self.assertIs(await self.client._spawn_protocol(self.request_to(port)), protocol,
+                "Connection was not kept in the pool")
+
+    @asynctest
+    async def test_failed_connection_is_retried(self):
+        # Find a port nobody listens on
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        with self.assertRaises(error.NetworkError):
+            await self.client._spawn_protocol(self.request_to(port))
+        self.assertEqual(self.client._pool, {}, "Failed attempt was left in the pool")
+
+        await self.listen(port)
+        await self.client._spawn_protocol(self.request_to(port))
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(self.accepted, 1, "Later request did not connect anew")
@@ -0,0 +1,200 @@
+# SPDX-FileCopyrightText: Christian Amsüss and the aiocoap contributors
+#
+# SPDX-License-Identifier: MIT
+
+"""Drive a CoAP over TCP connection object directly through a stub transport,
+for behavior that is impractical to provoke through real sockets"""
+
+import logging
+import random
+import unittest
+from unittest import mock
+
+import aiocoap
+from aiocoap.transports import tcp
+
+class _StubContext:
+    _scheme = 'coap+tcp'
+    _default_port = aiocoap.COAP_PORT
+
+    def __init__(self):
+        self.incoming = []
+        self.errors = []
+
+    def _dispatch_incoming_batch(self, connection, msgs):
+        self.incoming.extend(msgs)
+
+    def _dispatch_error(self, connection, exc):
+        self.errors.append(exc)
+
+class _StubTransport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        # Called after every write, to simulate transport reactions
+        self.on_write = None
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        if self.on_write is not None:
+            self.on_write()
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name, default=None):
+        return {
+                'sockname': ('::1', 1234),
+                'peername': ('::1', 5678),
+                }.get(name, default)
+
+class _SmallConnection(tcp.TcpConnection):
+    _my_max_message_size = 200
+
+class WithStubConnection(unittest.TestCase):
+    connection_class = tcp.TcpConnection
+
+    def setUp(self):
+        self.ctx = _StubContext()
+        self.transport = _StubTransport()
+        self.connection = self.connection_class(self.ctx,
+                logging.getLogger("tcp-connection-test"), None, is_server=True)
+        self.connection.connection_made(self.transport)
+
+    def tearDown(self):
+        self.connection.connection_lost(None)
+
+    def sent_messages(self):
+        """Parse everything written to the transport, skipping the initial
+        CSM"""
+        messages, trail = [], b"".join(self.transport.written)
+        while trail:
+            size = tcp._extract_message_size(trail)
+            messages.append(tcp._decode_message(trail[:size]))
+            trail = trail[size:]
+        self.assertEqual(messages[0].code, aiocoap.CSM)
+        return messages[1:]
+
+    def assertAborted(self):
+        sent = self.sent_messages()
+        self.assertEqual([m.code for m in sent], [aiocoap.ABORT], "Connection was not aborted")
+        self.assertTrue(self.transport.closed, "Transport was not closed")
+
+class TestSmallMaxMessageSize(WithStubConnection):
+    connection_class = _SmallConnection
+
+    def test_announced_2byte_length(self):
+        # 269 bytes minimum already exceed the limit
+        self.connection.data_received(b'\xe0')
+        self.assertAborted()
+
+    def test_announced_4byte_length(self):
+        self.connection.data_received(b'\xf0')
+        self.assertAborted()
+
+    def test_announced_1byte_length(self):
+        # could still fit, so this waits for the length
+        self.connection.data_received(b'\xd0')
+        self.assertEqual(self.sent_messages(), [])
+        self.assertFalse(self.transport.closed)
+
+class TestReceiveBuffer(WithStubConnection):
+    def test_fragmented_stream(self):
+        rng = random.Random(42)
+        messages = [
+                aiocoap.Message(
+                    code=aiocoap.GET if i % 2 else aiocoap.CONTENT,
+                    token=bytes((i,)),
+                    payload=bytes(rng.choice((0, 10, 1000, 70000, 300000))),
+                    )
+                for i in range(40)]
+        stream = tcp._serialize(aiocoap.Message(code=aiocoap.CSM)) + \
+                b"".join(tcp._serialize(m) for m in messages)
+
+        position = 0
+        while position < len(stream):
+            chunk = rng.randrange(1, 30000)
+            if rng.random() < 0.5:
+                with self.connection.get_buffer(-1) as buf:
+                    chunk = min(chunk, len(buf), len(stream) - position)
+                    buf[:chunk] = stream[position:position + chunk]
+                self.connection.buffer_updated(chunk)
+            else:
+                self.connection.data_received(stream[position:position + chunk])
+            position += chunk
+
+        self.assertEqual(
+                [(m.code, m.token, m.payload) for m in self.ctx.incoming],
+                [(m.code, m.token, m.payload) for m in messages],
+                "Messages were not dispatched completely and in order")
+        self.assertEqual(self.sent_messages(), [], "Connection sent unexpected messages")
+
+        # The next read finds the spool empty, and shrinks it back
+        self.connection.get_buffer(-1).release()
+        self.assertEqual(len(self.connection._spool), tcp._SPOOL_MIN_FREE,
+                "Spool did not return to its idle size")
+
+class TestWriteFlowControl(WithStubConnection):
+    def send(self, payload=b"x"):
+        self.connection._send_message(aiocoap.Message(code=aiocoap.CONTENT, token=b"t", payload=payload))
+
+    def test_queued_while_paused(self):
+        self.connection.pause_writing()
+        self.send(b"1")
+        self.send(b"2")
+        self.assertEqual(self.sent_messages(), [], "Data written while paused")
+
+        self.connection.resume_writing()
+        self.assertEqual([m.payload for m in self.sent_messages()], [b"1", b"2"])
+        self.assertEqual(self.connection._write_queue, [])
+
+    def test_repaused_during_flush(self):
+        self.connection.pause_writing()
+        self.send(b"1")
+        self.send(b"2")
+
+        self.transport.on_write = self.connection.pause_writing
+        self.connection.resume_writing()
+        self.assertEqual([m.payload for m in self.sent_messages()], [b"1"])
+
+        self.transport.on_write = None
+        self.connection.resume_writing()
+        self.assertEqual([m.payload for m in self.sent_messages()], [b"1", b"2"])
+
+    @mock.patch.object(tcp, '_WRITE_QUEUE_LIMIT', 10000)
+    def test_overflow_aborts_once(self):
+        self.connection.pause_writing()
+        for _ in range(500):
+            self.send(bytes(1000))
+
+        self.assertAborted()
+        self.assertEqual(self.connection._write_queue, [], "Data left queued after abort")
+        self.assertEqual(self.connection._write_queue_size, 0)
+
+    def test_abort_during_flush(self):
+        self.connection.pause_writing()
+        self.send(b"1")
+        self.send(b"2")
+
+        def abort_once():
+            self.transport.on_write = None
+            self.connection.abort("Test abort")
+        self.transport.on_write = abort_once
+        self.connection.resume_writing()
+
+        self.assertEqual([m.code for m in self.sent_messages()], [aiocoap.CONTENT, aiocoap.ABORT])
+        self.assertEqual(self.connection._write_queue, [], "Data re-queued after abort")
+
+        self.send(b"3")
+        self.assertEqual(len(self.sent_messages()), 2, "Data written after abort")
+
+    def test_connection_lost_drops_queue(self):
+        self.connection.pause_writing()
+        self.send(b"1")
+
+        self.connection.connection_lost(None)
+        self.assertEqual(self.connection._write_queue, [])
+        self.assertEqual(self.connection._write_queue_size, 0)
+
+        self.send(b"2")
+        self.assertEqual(self.connection._write_queue, [], "Data queued after connection loss")